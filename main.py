@@ -1,34 +1,161 @@
 import os
 import asyncio
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import signal
+import re
+import tempfile
 import time
+from collections import OrderedDict
+
+import markdown
+import numpy as np
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from aiolimiter import AsyncLimiter
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-from nio import (AsyncClient, RoomMessageText, MatrixRoom, LoginResponse, InviteMemberEvent)
+from nio import (AsyncClient, RoomMessageText, MatrixRoom, LoginResponse, InviteMemberEvent, RoomSendResponse,
+                 UploadFilterResponse, WhoamiResponse, SyncResponse)
 
 # --- Configuration ---
 MATRIX_HOMESERVER = os.environ.get("MATRIX_HOMESERVER")
 MATRIX_USER_ID = os.environ.get("MATRIX_USER_ID")
 MATRIX_PASSWORD = os.environ.get("MATRIX_PASSWORD")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+GEMINI_MODEL = "gemini-2.5-flash"
+EMBEDDING_MODEL = "gemini-embedding-001"
+FAQ_TOP_K = int(os.environ.get("FAQ_TOP_K", "4"))
+GEMINI_RPM = int(os.environ.get("GEMINI_RPM", "10"))
+GEMINI_MAX_ATTEMPTS = 3
+AI_CONCURRENCY = 8
+MIN_QUESTION_LENGTH = 8
+STREAM_FIRST_MESSAGE_CHARS = 80
+STREAM_EDIT_INTERVAL = 1.0  # seconds
+STREAM_MAX_EDITS = 3
+TYPING_TIMEOUT_MS = 30000
 FEDORA_COREOS_DOCS_URL = "https://docs.fedoraproject.org/en-US/fedora-coreos/"
+AI_CACHE_MAXSIZE = 1024
+AI_CACHE_TTL = 3600  # seconds
+SYNC_TIMELINE_LIMIT = 10
+SEEN_EVENTS_MAXSIZE = 4096
+CONTEXT_CACHE_TTL = 3600  # seconds
+CONTEXT_CACHE_REFRESH_MARGIN = 300  # seconds
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "fcos-bot")
+SESSION_FILE = os.path.join(CACHE_DIR, "session.json")
+
+log = logging.getLogger("fcos-bot")
+
+_MARKUP_CHARS = "<*_`#["
+_FAQ_SECTION_RE = re.compile(r"^(?===? )", re.MULTILINE)
+_QUESTION_RE = re.compile(
+    r"\?|\b(what|why|how|when|where|which|who|can|could|does|do|is|are|should|help)\b",
+    re.IGNORECASE,
+)
+
+
+class _NormalizeTable(dict):
+    """A str.translate table that lowercases word characters and deletes everything
+    but word characters and whitespace, so normalizing takes a single pass.
+
+    Latin-1 is precomputed; other code points are mapped on lookup without being
+    stored, so arbitrary user input cannot grow the table.
+    """
+
+    def __init__(self):
+        super().__init__((codepoint, self.__missing__(codepoint)) for codepoint in range(0x100))
+
+    def __missing__(self, codepoint: int):
+        char = chr(codepoint)
+        if char.isalnum() or char == "_":
+            return char.lower()
+        return char if char.isspace() else None
+
+
+_NORMALIZE_TABLE = _NormalizeTable()
+
+
+def _split_sections(text: str) -> list[str]:
+    """Splits an AsciiDoc document into its top-level sections."""
+    return [section.strip() for section in _FAQ_SECTION_RE.split(text) if section.strip()]
+
+
+def _normalize(text: str) -> str:
+    """Normalizes a question so trivially different phrasings share a cache key."""
+    return " ".join(text.translate(_NORMALIZE_TABLE).split())
+
+
+def _markdown_to_html(message: str) -> str:
+    """Renders the Markdown used in AI answers as HTML."""
+    return markdown.markdown(message, extensions=["fenced_code"])
+
+
+def _text_content(message: str) -> dict:
+    """Builds the content of an m.text message, adding HTML only when the text has markup."""
+    content = {"msgtype": "m.text", "body": message}
+    if any(c in message for c in _MARKUP_CHARS):
+        content["format"] = "org.matrix.custom.html"
+        content["formatted_body"] = _markdown_to_html(message)
+    return content
+
 
 class MatrixBot:
     """A Matrix bot that answers questions about Fedora CoreOS using a local knowledge base, a documentation URL, and Google Search."""
 
     def __init__(self):
         """Initializes the bot, AI client, and its configuration."""
+        # Both clients are created once and reused for the lifetime of the bot so
+        # their underlying HTTP sessions (aiohttp for nio, the SDK's pooled client
+        # for GenAI) keep connections alive instead of re-handshaking per request.
         self.matrix_client = AsyncClient(MATRIX_HOMESERVER, MATRIX_USER_ID)
-        self.start_time_ms = int(time.time() * 1000)
 
         # Initialize the GenAI Client using the API key.
         self.genai_client = genai.Client(api_key=GEMINI_API_KEY)
+        # Queue bursts locally instead of letting them fail with 429s from the API.
+        self._gemini_limiter = AsyncLimiter(max_rate=GEMINI_RPM, time_period=60)
 
         # Load local knowledge base from the faq.adoc file.
-        faq_context = self.load_context_from_file("faq.adoc")
+        self.faq_context = self.load_context_from_file("faq.adoc")
+        # FAQ sections and their unit-length embeddings, once retrieval is set up.
+        self._faq_sections: list[str] = []
+        self._faq_embeddings: np.ndarray | None = None
 
         # Define the system instructions for the AI model.
-        self.system_instruction = f"""You are an expert virtual assistant specializing in Fedora CoreOS (FCOS).
+        self.system_instruction = self.build_system_instruction(self.faq_context)
+        # The new SDK uses a generic Google Search tool to enable web Browse.
+        self.tools = [types.Tool(google_search=types.GoogleSearch()), types.Tool(url_context=types.UrlContext())]
+        # Requests share one config, built once. It is swapped for a reference to a
+        # Gemini context cache holding the instructions and tools once that exists.
+        self._inline_config = types.GenerateContentConfig(
+            system_instruction=self.system_instruction,
+            tools=self.tools
+        )
+        self._gen_config = self._inline_config
+        self._context_cache_name = None
+
+        # Recent AI answers keyed by normalized question: {key: (timestamp, answer)}.
+        self._ai_cache: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+        # Questions are answered in background tasks so the sync loop keeps running.
+        self._ai_sem = asyncio.Semaphore(AI_CONCURRENCY)
+        self._tasks: set[asyncio.Task] = set()
+        # Identical questions asked while an answer is pending share one Gemini call.
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._skipped_messages = 0
+        # IDs of recently handled events, so a redelivered event is never answered twice.
+        self._seen_events: OrderedDict[str, None] = OrderedDict()
+
+    def build_system_instruction(self, knowledge_base: str) -> str:
+        """Builds the system instruction around the given knowledge base text."""
+        return f"""You are an expert virtual assistant specializing in Fedora CoreOS (FCOS).
 
 Your primary task is to answer user questions accurately. Follow these steps:
 1.  First, consult the internal knowledge base provided below.
@@ -40,88 +167,480 @@ Your primary task is to answer user questions accurately. Follow these steps:
 
 The relevant URL for the Wiki is: {FEDORA_COREOS_DOCS_URL}
 --- INTERNAL KNOWLEDGE BASE ---
-{faq_context}
+{knowledge_base}
 --- END OF KNOWLEDGE BASE ---
 """
-        # The new SDK uses a generic Google Search tool to enable web Browse.
-        self.tools = [types.Tool(google_search=types.GoogleSearch()), types.Tool(url_context=types.UrlContext())]
 
     def load_context_from_file(self, file_path: str) -> str:
         """Loads the entire content of a given file into a string."""
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 context = f.read()
-            print(f"Successfully loaded context from {file_path}")
+            log.info("Successfully loaded context from %s", file_path)
             return context
         except FileNotFoundError:
-            print(f"Warning: The context file '{file_path}' was not found. The bot will run without it.")
+            log.warning("The context file '%s' was not found. The bot will run without it.", file_path)
             return ""
         except Exception as e:
-            print(f"An error occurred while loading context file: {e}")
+            log.error("An error occurred while loading context file: %s", e)
             return ""
 
+    def get_cached_answer(self, key: str) -> str | None:
+        """Returns a cached AI answer for the given key if it has not expired."""
+        entry = self._ai_cache.get(key)
+        if entry is None:
+            return None
+        timestamp, answer = entry
+        if time.monotonic() - timestamp > AI_CACHE_TTL:
+            del self._ai_cache[key]
+            return None
+        self._ai_cache.move_to_end(key)
+        return answer
+
+    def cache_answer(self, key: str, answer: str):
+        """Stores an AI answer, evicting the least recently used entries when full."""
+        self._ai_cache[key] = (time.monotonic(), answer)
+        self._ai_cache.move_to_end(key)
+        while len(self._ai_cache) > AI_CACHE_MAXSIZE:
+            self._ai_cache.popitem(last=False)
+
+    async def load_faq_embeddings(self):
+        """Embeds the FAQ sections so only the relevant ones are sent with each question.
+
+        Embeddings are cached on disk keyed by the FAQ content, so restarts don't re-embed it.
+        """
+        if FAQ_TOP_K <= 0 or not self.faq_context:
+            return
+        sections = _split_sections(self.faq_context)
+        digest = hashlib.blake2b(
+            f"{EMBEDDING_MODEL}\n{self.faq_context}".encode('utf-8'), digest_size=16
+        ).hexdigest()
+        embeddings_file = os.path.join(CACHE_DIR, f"faq-embeddings-{digest}.npy")
+
+        embeddings = None
+        try:
+            embeddings = np.load(embeddings_file)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.error("An error occurred while loading cached FAQ embeddings, re-embedding: %s", e)
+
+        if embeddings is None:
+            try:
+                response = await self.genai_client.aio.models.embed_content(
+                    model=EMBEDDING_MODEL,
+                    contents=sections,
+                    config=types.EmbedContentConfig(task_type="RETRIEVAL_DOCUMENT")
+                )
+            except Exception as e:
+                log.warning("Could not embed the FAQ, sending it whole instead: %s", e)
+                return
+            embeddings = np.array([embedding.values for embedding in response.embeddings], dtype=np.float32)
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+            self.save_faq_embeddings(embeddings_file, embeddings)
+
+        self._faq_sections = sections
+        self._faq_embeddings = embeddings
+        self.system_instruction = self.build_system_instruction(
+            "The excerpts relevant to each question are included at the start of the user's message."
+        )
+        self._inline_config = types.GenerateContentConfig(
+            system_instruction=self.system_instruction,
+            tools=self.tools
+        )
+        self._gen_config = self._inline_config
+        log.info("Embedded %d FAQ sections for retrieval", len(sections))
+
+    def save_faq_embeddings(self, embeddings_file: str, embeddings: np.ndarray):
+        """Writes the embeddings through a temporary file so a crash never leaves a partial file."""
+        tmp_path = None
+        try:
+            os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix=".tmp", delete=False) as f:
+                tmp_path = f.name
+                np.save(f, embeddings)
+            os.replace(tmp_path, embeddings_file)
+        except Exception as e:
+            log.error("An error occurred while saving FAQ embeddings: %s", e)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def build_contents(self, user_text: str) -> str:
+        """Prepends the FAQ sections most similar to the question, when retrieval is set up."""
+        if self._faq_embeddings is None:
+            return user_text
+        try:
+            response = await self.genai_client.aio.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=user_text,
+                config=types.EmbedContentConfig(task_type="RETRIEVAL_QUERY")
+            )
+        except Exception as e:
+            log.warning("Could not embed the question, sending it without FAQ excerpts: %s", e)
+            return user_text
+
+        query = np.array(response.embeddings[0].values, dtype=np.float32)
+        similarities = self._faq_embeddings @ (query / np.linalg.norm(query))
+        k = min(FAQ_TOP_K, len(self._faq_sections))
+        top = np.sort(np.argpartition(-similarities, k - 1)[:k])
+        excerpts = "\n\n".join(self._faq_sections[i] for i in top)
+        return f"""--- KNOWLEDGE BASE EXCERPTS ---
+{excerpts}
+--- END OF EXCERPTS ---
+
+{user_text}"""
+
+    async def create_context_cache(self):
+        """Uploads the system instruction and tools to a Gemini context cache."""
+        try:
+            cache = await self.genai_client.aio.caches.create(
+                model=GEMINI_MODEL,
+                config=types.CreateCachedContentConfig(
+                    display_name="fcos-assistant",
+                    system_instruction=self.system_instruction,
+                    tools=self.tools,
+                    ttl=f"{CONTEXT_CACHE_TTL}s"
+                )
+            )
+        except Exception as e:
+            log.warning("Could not create context cache, sending the instructions inline: %s", e)
+            self._context_cache_name = None
+            self._gen_config = self._inline_config
+            return
+        self._context_cache_name = cache.name
+        self._gen_config = types.GenerateContentConfig(cached_content=cache.name)
+        log.info("Created context cache %s", cache.name)
+
+    async def refresh_context_cache(self):
+        """Keeps the context cache alive by extending its TTL before it expires.
+
+        Stops once the cache can no longer be recreated; requests then use the inline config.
+        """
+        while self._context_cache_name is not None:
+            await asyncio.sleep(CONTEXT_CACHE_TTL - CONTEXT_CACHE_REFRESH_MARGIN)
+            try:
+                await self.genai_client.aio.caches.update(
+                    name=self._context_cache_name,
+                    config=types.UpdateCachedContentConfig(ttl=f"{CONTEXT_CACHE_TTL}s")
+                )
+            except Exception as e:
+                log.warning("Could not refresh context cache, recreating it: %s", e)
+                await self.create_context_cache()
+
+    async def delete_context_cache(self):
+        """Deletes the context cache so it stops accruing storage time."""
+        if self._context_cache_name is None:
+            return
+        try:
+            await self.genai_client.aio.caches.delete(name=self._context_cache_name)
+        except Exception as e:
+            log.warning("Could not delete context cache: %s", e)
+
+    async def stream_answer(self, room_id: str, contents: str) -> str:
+        """Streams a Gemini answer into the room, editing one message as chunks arrive.
+
+        Rate-limited requests are retried with backoff as long as nothing has been sent yet.
+        """
+        for attempt in range(GEMINI_MAX_ATTEMPTS):
+            text = ""
+            shown = ""
+            sent = False
+            event_id = None
+            edits = 0
+            last_update = 0.0
+            try:
+                async with self._gemini_limiter:
+                    stream = await self.genai_client.aio.models.generate_content_stream(
+                        model=GEMINI_MODEL,
+                        contents=contents,
+                        config=self._gen_config
+                    )
+                async for chunk in stream:
+                    text += chunk.text or ""
+                    now = time.monotonic()
+                    if not sent:
+                        if len(text) >= STREAM_FIRST_MESSAGE_CHARS:
+                            event_id = await self.send_message(room_id, text)
+                            sent, shown, last_update = True, text, now
+                    elif (event_id and edits < STREAM_MAX_EDITS
+                          and now - last_update >= STREAM_EDIT_INTERVAL):
+                        await self.edit_message(room_id, event_id, text)
+                        edits, shown, last_update = edits + 1, text, now
+
+                if not text:
+                    # e.g. a safety block or a response with only tool parts.
+                    raise ValueError("Gemini returned an empty answer")
+                if not sent:
+                    await self.send_message(room_id, text)
+                elif event_id and text != shown:
+                    await self.edit_message(room_id, event_id, text)
+                return text
+            except errors.APIError as e:
+                if e.code != 429 or sent or attempt == GEMINI_MAX_ATTEMPTS - 1:
+                    raise
+                delay = min(2 ** attempt + random.random(), 30)
+                log.warning("Gemini rate limit hit, retrying in %.1fs", delay)
+                await asyncio.sleep(delay)
+
+    def restore_session(self) -> bool:
+        """Restores the access token and sync position saved by a previous run."""
+        try:
+            with open(SESSION_FILE, 'r', encoding='utf-8') as f:
+                session = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            log.error("An error occurred while loading the saved session: %s", e)
+            return False
+
+        device_id = session.get("device_id")
+        access_token = session.get("access_token")
+        if session.get("user_id") != MATRIX_USER_ID or not device_id or not access_token:
+            return False
+        self.matrix_client.restore_login(
+            user_id=MATRIX_USER_ID,
+            device_id=device_id,
+            access_token=access_token
+        )
+        self.matrix_client.next_batch = session.get("next_batch")
+        return True
+
+    def save_session(self):
+        """Saves the access token and sync position so the next run can skip logging in."""
+        session = {
+            "user_id": self.matrix_client.user_id,
+            "device_id": self.matrix_client.device_id,
+            "access_token": self.matrix_client.access_token,
+            "next_batch": self.matrix_client.next_batch,
+        }
+        try:
+            os.makedirs(os.path.dirname(SESSION_FILE), mode=0o700, exist_ok=True)
+            fd = os.open(SESSION_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(session, f)
+        except Exception as e:
+            log.error("An error occurred while saving the session: %s", e)
+
     async def login(self):
-        """Logs the bot into the Matrix homeserver."""
-        print("Logging in...")
+        """Logs the bot into the Matrix homeserver, reusing a saved session when possible."""
+        if self.restore_session():
+            response = await self.matrix_client.whoami()
+            if isinstance(response, WhoamiResponse):
+                log.info("Restored session for %s", MATRIX_USER_ID)
+                return
+            log.warning("Saved session is no longer valid: %s", response)
+            self.matrix_client.next_batch = None
+
+        log.info("Logging in...")
         response = await self.matrix_client.login(MATRIX_PASSWORD, device_name="fedora-qa-bot")
         if isinstance(response, LoginResponse):
-            print(f"Successfully logged in as {MATRIX_USER_ID}")
+            log.info("Successfully logged in as %s", MATRIX_USER_ID)
+            self.save_session()
         else:
-            print(f"Failed to log in: {response}")
+            log.error("Failed to log in: %s", response)
             await self.matrix_client.close()
             exit(1)
 
+    def build_sync_filter(self, timeline_limit: int) -> dict:
+        """Builds a sync filter for just the events the bot handles."""
+        return {
+            "presence": {"types": []},
+            "room": {
+                "timeline": {"limit": timeline_limit, "types": ["m.room.message"]},
+                "state": {"lazy_load_members": True},
+                "ephemeral": {"types": []},
+            },
+        }
+
+    async def upload_sync_filter(self, timeline_limit: int):
+        """Uploads a sync filter for just the events the bot handles and returns its ID."""
+        sync_filter = self.build_sync_filter(timeline_limit)
+        response = await self.matrix_client.upload_filter(**sync_filter)
+        if isinstance(response, UploadFilterResponse):
+            return response.filter_id
+        log.warning("Failed to upload sync filter, sending it inline: %s", response)
+        return sync_filter
+
     async def message_callback(self, room: MatrixRoom, event: RoomMessageText):
         """Callback for handling incoming text messages."""
         if event.sender == self.matrix_client.user_id:
             return
 
-        if event.server_timestamp < self.start_time_ms:
+        if event.event_id in self._seen_events:
             return
-        
+        self._seen_events[event.event_id] = None
+        if len(self._seen_events) > SEEN_EVENTS_MAXSIZE:
+            self._seen_events.popitem(last=False)
+
         user_text = event.body
-        print(f"Received message from {event.sender} in {room.display_name}: {user_text}")
+        log.info("Received message from %s in %s: %s", event.sender, room.display_name, user_text)
 
+        # Don't spend Gemini quota on chatter such as "thanks" or "ok".
+        if len(user_text) < MIN_QUESTION_LENGTH or not _QUESTION_RE.search(user_text):
+            self._skipped_messages += 1
+            log.debug("Skipped non-question message (%d so far)", self._skipped_messages)
+            return
+
+        cache_key = _normalize(user_text)
+        cached = self.get_cached_answer(cache_key)
+        if cached is not None:
+            await self.send_message(room.room_id, cached)
+            return
+
+        task = asyncio.create_task(self.answer_question(room.room_id, user_text, cache_key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def answer_question(self, room_id: str, user_text: str, cache_key: str):
+        """Answers a question with Gemini, sharing the answer with identical pending questions."""
+        # Show the typing notification while the FAQ lookup and Gemini call run.
+        typing = asyncio.create_task(self.set_typing(room_id, True))
         try:
-            # Generate content using the user's message.
-            # The new syntax passes the model, contents, and config to the generate_content method.
-            response = await self.genai_client.aio.models.generate_content(
-                model='gemini-2.5-flash',
-                contents=user_text,
-                config=types.GenerateContentConfig(
-                    system_instruction=self.system_instruction,
-                    tools=self.tools
-                )
-            )
-            await self.send_message(room.room_id, response.text)
+            future = self._inflight.get(cache_key)
+            if future is not None:
+                # Shield so a cancelled waiter does not cancel the answer for the others.
+                answer = await asyncio.shield(future)
+                await self.send_message(room_id, answer)
+                return
+
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[cache_key] = future
+            try:
+                contents = await self.build_contents(user_text)
+                async with self._ai_sem:
+                    answer = await self.stream_answer(room_id, contents)
+                if answer:
+                    self.cache_answer(cache_key, answer)
+                future.set_result(answer)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                if not future.done():
+                    future.cancel()
+                del self._inflight[cache_key]
+            # Re-raises the error, if any, for this room as well.
+            future.result()
 
         except Exception as e:
-            print(f"Error calling Gemini API: {e}")
-            await self.send_message(room.room_id, "Sorry, an error occurred with the AI.")
+            log.error("Error calling Gemini API: %s", e)
+            await self.send_message(room_id, "Sorry, an error occurred with the AI.")
+        finally:
+            await typing
+            await self.set_typing(room_id, False)
+
+    async def set_typing(self, room_id: str, typing: bool):
+        """Shows or clears the bot's typing notification in a room."""
+        try:
+            await self.matrix_client.room_typing(room_id, typing, timeout=TYPING_TIMEOUT_MS)
+        except Exception as e:
+            log.warning("Could not update typing notification: %s", e)
 
     async def auto_join_invites(self, room: MatrixRoom, event: InviteMemberEvent):
         """Callback to automatically join a room when invited."""
         if event.state_key == self.matrix_client.user_id:
-            print(f"Joining invited room: {room.room_id}")
+            log.info("Joining invited room: %s", room.room_id)
             await self.matrix_client.join(room.room_id)
 
     async def send_message(self, room_id, message):
-        """Sends a text message to a specific Matrix room."""
+        """Sends a text message to a specific Matrix room and returns its event ID."""
+        response = await self.matrix_client.room_send(
+            room_id=room_id,
+            message_type="m.room.message",
+            content=_text_content(message)
+        )
+        if isinstance(response, RoomSendResponse):
+            return response.event_id
+        return None
+
+    async def edit_message(self, room_id, event_id, message):
+        """Replaces the text of a previously sent message."""
         await self.matrix_client.room_send(
             room_id=room_id,
             message_type="m.room.message",
-            content={"msgtype": "m.text", "body": message, "formatted_body": message, "format": "org.matrix.custom.html"}
+            content={
+                "msgtype": "m.text",
+                "body": f"* {message}",
+                "m.new_content": _text_content(message),
+                "m.relates_to": {"rel_type": "m.replace", "event_id": event_id},
+            }
         )
     
     async def run(self):
         """The main loop for the bot."""
+        # Turn SIGTERM (systemd, docker stop) into a cancellation so the cleanup below
+        # still saves the sync position and deletes the context cache.
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except NotImplementedError:
+            pass
         await self.login()
-        self.matrix_client.add_event_callback(self.message_callback, RoomMessageText)
         self.matrix_client.add_event_callback(self.auto_join_invites, InviteMemberEvent)
-        print("Bot is running and listening for messages...")
-        await self.matrix_client.sync_forever(timeout=30000)
+
+        # Catch up before listening for messages, so anything sent while the bot was
+        # offline is skipped by sync position rather than by comparing clocks. The
+        # filter is only used once, so it is sent inline instead of being uploaded.
+        catch_up_filter = self.build_sync_filter(timeline_limit=1)
+        while not isinstance(
+            response := await self.matrix_client.sync(timeout=0, sync_filter=catch_up_filter),
+            SyncResponse
+        ):
+            log.warning("Initial sync failed, retrying: %s", response)
+            await asyncio.sleep(5)
+
+        await self.load_faq_embeddings()
+        # With retrieval the instruction is too short for explicit caching, so only
+        # cache it when the whole FAQ is sent.
+        cache_refresher = None
+        if self._faq_embeddings is None:
+            await self.create_context_cache()
+            if self._context_cache_name is not None:
+                cache_refresher = asyncio.create_task(self.refresh_context_cache())
+
+        self.matrix_client.add_event_callback(self.message_callback, RoomMessageText)
+        sync_filter = await self.upload_sync_filter(timeline_limit=SYNC_TIMELINE_LIMIT)
+        log.info("Bot is running and listening for messages...")
+        try:
+            await self.matrix_client.sync_forever(
+                timeout=30000,
+                full_state=False,
+                sync_filter=sync_filter
+            )
+        finally:
+            background = list(self._tasks)
+            if cache_refresher is not None:
+                background.append(cache_refresher)
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+            await self.delete_context_cache()
+            self.save_session()
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Routes log records through a queue so writing them never blocks the event loop."""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    # Only the bot's own logger follows LOG_LEVEL; libraries such as httpx stay at WARNING.
+    root.setLevel(logging.WARNING)
+    log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    listener.start()
+    return listener
 
 
 if __name__ == "__main__":
-    bot = MatrixBot()
-    asyncio.run(bot.run())
\ No newline at end of file
+    listener = setup_logging()
+    try:
+        bot = MatrixBot()
+        # uvloop is a faster drop-in event loop; fall back to asyncio's where it isn't available.
+        if uvloop is not None:
+            uvloop.run(bot.run())
+        else:
+            asyncio.run(bot.run())
+    except asyncio.CancelledError:
+        log.info("Bot stopped")
+    finally:
+        listener.stop()
\ No newline at end of file